@@ -4,24 +4,69 @@ from llama_cpp import Llama
 import numpy as np
 import numpy.typing as npt
 from typing import List
+import os
+import queue
+import re
+import threading
 from time import time
 from random import randint
 
+# control markers used by the prompt templates in loadPrompt, e.g. <|im_start|> or </s>
+specialTokenPattern = re.compile(r"<\|[A-Za-z_]+\|>|</?s>")
+
+# splits a prompt right before every marker in controlTokens. llama.cpp itself splits the text at control tokens
+# when special token parsing is enabled, so as long as every marker in controlTokens is a single control token in
+# the model's vocab each part tokenizes to exactly the same ids as it does inside the full prompt. Markers that are
+# plain text in the vocab (e.g. <|user|> for zephyr-beta) must not be passed, the part after them would gain a
+# SentencePiece prefix space
+def splitAtSpecialTokens(prompt: str, controlTokens: set) -> List[str]:
+    starts = [0] + [match.start() for match in specialTokenPattern.finditer(prompt)
+                    if match.start() > 0 and match.group() in controlTokens]
+    return [prompt[start:end] for start, end in zip(starts, starts[1:] + [len(prompt)])]
+
+def commonPrefixLength(a: npt.NDArray[np.intc], b: npt.NDArray[np.intc]) -> int:
+    n = min(len(a), len(b))
+    mismatches = np.flatnonzero(a[:n] != b[:n])
+    return int(mismatches[0]) if mismatches.size else n
+
+# number of bytes still missing from a multi-byte UTF-8 character that was started at the end of piece
+def utf8MissingBytes(piece: bytes) -> int:
+    start = len(piece) - 1
+    while start >= max(0, len(piece) - 4) and piece[start] >> 6 == 0b10:   # skip continuation bytes
+        start -= 1
+    if start < 0 or start < len(piece) - 4:
+        return 0
+
+    lead = piece[start]
+    expected = 4 if lead >> 3 == 0b11110 else 3 if lead >> 4 == 0b1110 else 2 if lead >> 5 == 0b110 else 1
+    return max(0, expected - (len(piece) - start))
+
 class LlamaModel:
     def __init__(self, parameters: LLMUtils.LLMConfig):
         self.parameters = parameters
         self.threadCount = self.parameters.threads
+        physicalCores = LLMUtils.physicalCoreCount()
+        if self.threadCount <= 0 or self.threadCount > physicalCores:
+            self.threadCount = physicalCores
         if self.threadCount < 6:
             print("Low thread count. Inference might be slow.")
 
         self.ctxParams = self.parameters.getCtxParms()
         self.ctxParams.n_ctx = self.parameters.nCtx  # default
         self.ctxParams.n_threads = self.threadCount
+        self.ctxParams.n_threads_batch = physicalCores
+        self.ctxParams.n_batch = self.parameters.n_batch
+        if hasattr(self.ctxParams, "n_ubatch"):
+            self.ctxParams.n_ubatch = self.parameters.n_batch
         if self.ctxParams.seed <= 0:
             self.ctxParams.seed = int(randint(0, int(time())))
 
         self.modelParams = self.parameters.getModelParams()
-        self.modelParams.n_gpu_layers = self.parameters.nOffloadLayer
+        self.modelParams.n_gpu_layers = (self.parameters.nOffloadLayer if self.parameters.nOffloadLayer >= 0
+                                         else 0x7FFFFFFF)  # same convention as llama_cpp.Llama
+        if self.parameters.nOffloadLayer != 0 and LLMUtils.gpuOffloadSupported() is False:
+            print("LLMCore: GPU offloading was requested but the installed llama-cpp-python build does not support it. "
+                  "Reinstall it with CMAKE_ARGS=\"-DLLAMA_CUBLAS=on\" to run layers on the GPU.")
         self.modelParams.main_gpu = self.parameters.mainGPU
         self.modelPath = self.parameters.modelPath
 
@@ -34,6 +79,7 @@ class LlamaModel:
             self.warnAndExit(function="__init__", errorMessage="No model path found")
 
         if self.model:
+            self.checkQuantization()
             self.context = llama_cpp.llama_new_context_with_model(self.model, self.ctxParams)
 
         self.n_ctx = llama_cpp.llama_n_ctx(self.context)
@@ -41,18 +87,38 @@ class LlamaModel:
                                                                                               "No model was found")
         self.nCtx = llama_cpp.llama_n_ctx(self.context) if self.context else self.warnAndExit("__init__",
                                                                                               "No context was found")
+        self.controlTokenCache: dict[str, bool] = {}   # template marker -> is a single control token in the vocab
         self._init()
+        self.loadSession()
+
+    # unquantized weights have to cross PCIe every step when only part of the model is offloaded, and are memory
+    # bandwidth bound on the CPU when nothing is
+    def checkQuantization(self):
+        offloadedLayers = 0 if LLMUtils.gpuOffloadSupported() is False else self.modelParams.n_gpu_layers
+        nLayers = llama_cpp.llama_n_layer(self.model) if hasattr(llama_cpp, "llama_n_layer") else None
+        fullyOffloaded = (offloadedLayers >= nLayers + 1 if nLayers is not None
+                          else offloadedLayers > 0 and self.parameters.nOffloadLayer < 0)
+        if fullyOffloaded:
+            return
+
+        bytesPerParameter = llama_cpp.llama_model_size(self.model) / max(1, llama_cpp.llama_model_n_params(self.model))
+        if bytesPerParameter >= 0.8 * 2:   # at least 80% of the size of an FP16 model
+            placement = "is not offloaded to the GPU" if offloadedLayers == 0 else "is only partially offloaded"
+            print(f"LLMCore: '{self.modelPath}' does not appear to be quantized ({bytesPerParameter:.2f} bytes per "
+                  f"parameter) and {placement}. A Q4_K_M or Q5_K_M quantization needs far less memory "
+                  f"and is considerably faster.")
 
     def _init(self):
-        self.pCandidatesData = np.array(
-            [],
+        self.pCandidatesData = np.zeros(
+            (self.nVocab,),
             dtype=np.dtype(
                 [("id", np.intc), ("logit", np.single), ("p", np.single)],
                 align=True
             ),
         )
+        self.pCandidatesDataId = np.arange(self.nVocab, dtype=np.intc)
+        self.pCandidatesData["id"] = self.pCandidatesDataId
 
-        self.pCandidatesData.resize(3, self.nVocab, refcheck=False)
         candidates = llama_cpp.llama_token_data_array(
             data=self.pCandidatesData.ctypes.data_as(llama_cpp.llama_token_data_p),
             size=self.nVocab,
@@ -60,43 +126,192 @@ class LlamaModel:
         )
 
         self.pCandidates = candidates
+        self.cachedTokens: npt.NDArray[np.intc] = np.array([], dtype=np.intc)   # tokens whose KV cache is reusable
+        self.pCandidatesRef = llama_cpp.ctypes.byref(candidates)
+        self.lastNTokensBuffer = None
+        self.sessionCandidateTokens = 0   # prefix shared by the last two prompts, persisted on the next reset()
         self.EOSToken = 32000# llama_cpp.llama_token_eos(self.context)
-        self.pCandidatesDataId = np.arange(self.nVocab, dtype=np.intc)
-        self.pCandidatesDataP = np.zeros(self.nVocab, dtype=np.single)
         self.pastTokens = 0
 
         self.inputIds: npt.NDArray[np.intc] = np.ndarray((self.nCtx,), dtype=np.intc)
-        self.scores: npt.NDArray[np.single] = np.ndarray((self.nCtx, self.nVocab), dtype=np.single)
+        self.lastLogits: npt.NDArray[np.single] = np.empty((self.nVocab,), dtype=np.single)
+        self.scores: npt.NDArray[np.single] = (np.ndarray((self.nCtx, self.nVocab), dtype=np.single)
+                                               if self.parameters.logitsAll else None)  # full history is opt-in
+
+        self.tokenBuffer = (llama_cpp.llama_token * self.nCtx)()
+        self.tokenizerThreadBuffer = (llama_cpp.llama_token * self.nCtx)()    # owned by the tokenizeSegments thread
+        self.decodeBuffer = (llama_cpp.llama_token * 1)()
+
+        self.pieceBufferSize = 64
+        self.pieceBuffer = (llama_cpp.ctypes.c_char * self.pieceBufferSize)()
+        self.loadLogitBias()
 
     def reset(self):
+        self.saveSession(reusedTokens=self.sessionCandidateTokens)    # after the response, off the generation path
+        cachedTokens = self.inputIds[: self.pastTokens].copy()  # the context still holds their KV cache
         self._init()
+        self.cachedTokens = cachedTokens
+
+    # restores the KV cache of a previously persisted prompt prefix, e.g. the system prompt
+    def loadSession(self):
+        self.sessionTokens: npt.NDArray[np.intc] = np.array([], dtype=np.intc)
+        sessionPath = self.parameters.sessionPath
+        if sessionPath is None or not os.path.exists(sessionPath):
+            return
+
+        nTokens = llama_cpp.c_size_t(0)
+        if not llama_cpp.llama_load_session_file(self.context, sessionPath.encode("utf-8"), self.tokenBuffer,
+                                                 len(self.tokenBuffer), llama_cpp.ctypes.byref(nTokens)):
+            print(f"LLMCore: Failed to load session file '{sessionPath}', the prompt will be evaluated from scratch.")
+            return
+        self.sessionTokens = np.frombuffer(self.tokenBuffer, dtype=np.intc, count=nTokens.value).copy()
+        self.cachedTokens = self.sessionTokens
+
+    # persists the prefix the current prompt shares with the previous one, unless an equal or longer shared prefix
+    # is already on disk, so the file converges on the invariant part of the prompt and is rarely rewritten.
+    # llama_save_session_file writes the context's whole KV state, not only the prefix (roughly 0.5 MB per token for
+    # a 7B model), which is why this only runs from reset() once the response has been returned
+    def saveSession(self, reusedTokens: int):
+        sessionPath = self.parameters.sessionPath
+        if sessionPath is None or reusedTokens == 0:
+            return
+        if len(self.sessionTokens) > 0 and \
+                commonPrefixLength(self.sessionTokens, self.inputIds[: self.pastTokens]) == len(self.sessionTokens):
+            return
+
+        sessionTokens = self.inputIds[:reusedTokens].copy()
+        if llama_cpp.llama_save_session_file(self.context, sessionPath.encode("utf-8"),
+                                             (llama_cpp.llama_token * reusedTokens).from_buffer(sessionTokens),
+                                             reusedTokens):
+            self.sessionTokens = sessionTokens
+        else:
+            print(f"LLMCore: Failed to save session file '{sessionPath}'.")
 
     def update(self, newParameters: LLMUtils.LLMConfig):
         self.parameters = newParameters
         self.nCtx = self.parameters.nCtx
+        self.loadLogitBias()
+
+    def loadLogitBias(self):
+        self.logitBiasIds: npt.NDArray[np.intc] = np.fromiter(self.parameters.logit_bias.keys(), dtype=np.intc)
+        self.logitBiasValues: npt.NDArray[np.single] = np.fromiter(self.parameters.logit_bias.values(),
+                                                                   dtype=np.single)
 
     def warnAndExit(self, function, errorMessage):
         raise RuntimeError(f"LLMCore: Error in function: '{function}'. Following error message was provided: '{errorMessage}'\n")
 
-    def tokenizeFull(self, input: str, bos: bool = False, special: bool = True) -> List[int]:   # Possibly further abstract by adding single
-        tokens = (llama_cpp.llama_token * self.nCtx)()              # token, tokenization
+    # Possibly further abstract by adding single token tokenization
+    def tokenizeFull(self, input: str, bos: bool = False, special: bool = False,
+                     buffer=None) -> npt.NDArray[np.intc]:
+        tokens = self.tokenBuffer if buffer is None else buffer
+        text = input.encode("utf8")
         newTokens = llama_cpp.llama_tokenize(model=self.model,
-                                             text=input.encode("utf8"),
-                                             text_len=len(input.encode("utf8")),
+                                             text=text,
+                                             text_len=len(text),
                                              tokens=tokens,
-                                             n_max_tokens=self.nCtx,
+                                             n_max_tokens=len(tokens),
                                              add_bos=bos,
                                              special=special)
-        return list(tokens[:newTokens])
-
-    def evaluate(self, tokens: List[int], batch: int):
+        if newTokens < 0:   # doesn't fit the buffer, tokenize again so callers see the real count and can reject it
+            tokens = (llama_cpp.llama_token * -newTokens)()
+            newTokens = llama_cpp.llama_tokenize(model=self.model,
+                                                 text=text,
+                                                 text_len=len(text),
+                                                 tokens=tokens,
+                                                 n_max_tokens=len(tokens),
+                                                 add_bos=bos,
+                                                 special=special)
+        return np.frombuffer(tokens, dtype=np.intc, count=newTokens).copy()
+
+    def isControlToken(self, marker: str) -> bool:
+        if marker not in self.controlTokenCache:
+            tokens = self.tokenizeFull(marker, special=True)
+            self.controlTokenCache[marker] = (len(tokens) == 1 and
+                                              llama_cpp.llama_token_get_type(self.model, int(tokens[0]))
+                                              != llama_cpp.LLAMA_TOKEN_TYPE_NORMAL)
+        return self.controlTokenCache[marker]
+
+    # producer for generate(), runs on a background thread so tokenization overlaps with prefilling earlier parts
+    def tokenizeSegments(self, prompt: str, special: bool, controlTokens: set, output: queue.Queue):
+        buffer = self.tokenizerThreadBuffer
+        try:
+            for segment in (splitAtSpecialTokens(prompt, controlTokens) if controlTokens else [prompt]):
+                output.put(self.tokenizeFull(segment, special=special, buffer=buffer))
+        except Exception as e:
+            output.put(e)
+        output.put(None)
+
+    def receiveSegments(self, segments: queue.Queue):
+        while True:
+            segment = segments.get()
+            if segment is None:
+                return
+            if isinstance(segment, Exception):
+                raise segment
+            yield segment
+
+    def prefillPrompt(self, prompt: str) -> int:
+        if prompt == "":
+            bos = np.array([llama_cpp.llama_token_bos(self.context)], dtype=np.intc)
+            self.prefill(tokens=bos)
+            return len(bos)
+
+        # only pay for llama.cpp's special token matching when the rendered template actually contains markers.
+        # Tokenizing text and markers separately would change the SPM leading space handling
+        markers = set(specialTokenPattern.findall(prompt))
+        special = len(markers) > 0
+        controlTokens = {marker for marker in markers if self.isControlToken(marker)}   # cached per model
+        segments = queue.Queue(maxsize=2)
+        tokenizer = threading.Thread(target=self.tokenizeSegments, args=(prompt, special, controlTokens, segments),
+                                     daemon=True)
+        tokenizer.start()
+
+        promptTokens = 0
+        reusedTokens = 0
+        startTokens = self.pastTokens
+        # skip evaluating the prefix the prompt shares with the KV cache left behind by the last generation
+        reusing = self.pastTokens == 0
+        try:
+            for segment in self.receiveSegments(segments=segments):
+                promptTokens += len(segment)
+                if promptTokens >= self.parameters.nCtx:
+                    # earlier segments were already evaluated, forget them. Their KV positions are simply
+                    # overwritten by the next evaluation
+                    self.pastTokens = startTokens
+                    self.cachedTokens = self.cachedTokens[:reusedTokens]
+                    return promptTokens
+                if reusing:
+                    matched = commonPrefixLength(self.cachedTokens[self.pastTokens:], segment)
+                    self.inputIds[self.pastTokens : self.pastTokens + matched] = segment[:matched]
+                    self.pastTokens += matched
+                    reusedTokens += matched
+                    segment = segment[matched:]
+                    reusing = len(segment) == 0
+                self.prefill(tokens=segment)
+        finally:
+            while tokenizer.is_alive():   # unblock a pending put so the tokenizer thread can finish
+                try:
+                    segments.get_nowait()
+                except queue.Empty:
+                    tokenizer.join(timeout=0.01)
+
+        if reusing and self.pastTokens > 0:  # the whole prompt was cached, evaluate its last token again for logits
+            self.pastTokens -= 1
+            reusedTokens -= 1
+            self.decodeToken(token=int(self.inputIds[self.pastTokens]))
+        self.cachedTokens = self.cachedTokens[:0]   # positions past the reused prefix were overwritten
+        self.sessionCandidateTokens = reusedTokens
+        return promptTokens
+
+    def evaluate(self, tokens: npt.NDArray[np.intc], batch: int):
         if batch > 0:
+            tokens = np.require(tokens, dtype=np.intc, requirements=["C", "W"])   # no-op for tokenizeFull output
             for i in range(0, len(tokens), batch):
                 nBatch = tokens[i : min(len(tokens), i + batch)]
                 nPast = min(self.nCtx - len(nBatch), len(self.inputIds[: self.pastTokens]))
                 nTokens = len(nBatch)
                 evalCode = llama_cpp.llama_eval(ctx=self.context,
-                                                tokens=(llama_cpp.llama_token * len(nBatch))(*nBatch),
+                                                tokens=(llama_cpp.llama_token * nTokens).from_buffer(nBatch),
                                                 n_tokens=nTokens,
                                                 n_past=nPast,)
 
@@ -105,36 +320,61 @@ class LlamaModel:
                                                  f"size {batch}")
 
                 self.inputIds[self.pastTokens : self.pastTokens + nTokens] = nBatch
-                rows = nTokens if self.parameters.logitsAll else 1
-                cols = self.nVocab
-                offset = (0 if self.parameters.logitsAll else nTokens-1)
-                self.scores[self.pastTokens+offset:self.pastTokens+nTokens, :].reshape(-1)[:] \
-                    = llama_cpp.llama_get_logits(self.context)[: rows * cols]
+                self.storeLogits(nTokens=nTokens)
                 self.pastTokens += nTokens
 
+    def prefill(self, tokens: npt.NDArray[np.intc]):
+        # llama.cpp rejects batches larger than the n_batch the context was created with
+        self.evaluate(tokens=tokens, batch=min(self.parameters.n_batch, self.ctxParams.n_batch))
+
+    def decodeToken(self, token: int):
+        self.decodeBuffer[0] = token
+        evalCode = llama_cpp.llama_eval(ctx=self.context,
+                                        tokens=self.decodeBuffer,
+                                        n_tokens=1,
+                                        n_past=min(self.nCtx - 1, self.pastTokens),)
+        if evalCode != 0:
+            self.warnAndExit("decodeToken", f"Error occured during evaluation of token {token}")
+
+        self.inputIds[self.pastTokens] = token
+        self.storeLogits(nTokens=1)
+        self.pastTokens += 1
+
+    def storeLogits(self, nTokens: int):
+        rows = nTokens if self.parameters.logitsAll else 1
+        cols = self.nVocab
+        logits = np.ctypeslib.as_array(llama_cpp.llama_get_logits(self.context), shape=(rows, cols))
+        if self.parameters.logitsAll:
+            np.copyto(self.scores[self.pastTokens:self.pastTokens+nTokens, :], logits)
+        np.copyto(self.lastLogits, logits[-1, :])
+
     def sampleTokenWithModel(self):
         lastNTokensSize = self.parameters.n_keep if self.parameters.n_keep != -1 else self.nCtx
-        lastNTokensData = [llama_cpp.llama_token(0)] * max(
-            0, self.parameters.n_keep - len(self.inputIds[: self.pastTokens])
-        ) + self.inputIds[: self.pastTokens][-lastNTokensSize :].tolist()
-
-        lastNTokensData = (llama_cpp.llama_token * lastNTokensSize)(*lastNTokensData)
-
-        logits: npt.NDArray[np.single] = self.scores[: self.pastTokens, :][-1, :]
-        for token, bias in self.parameters.logit_bias.items():
-            logits[token] = logits[token] * bias
+        if self.lastNTokensBuffer is None or len(self.lastNTokensBuffer) != lastNTokensSize:
+            self.lastNTokensBuffer = (llama_cpp.llama_token * lastNTokensSize)()
+        lastNTokensData = self.lastNTokensBuffer
+        lastNTokensView: npt.NDArray[np.intc] = np.ctypeslib.as_array(lastNTokensData)
+        lastNTokens = self.inputIds[: self.pastTokens][-lastNTokensSize :]
+        padding = max(0, self.parameters.n_keep - self.pastTokens)
+        lastNTokensView.fill(0)
+        lastNTokensView[padding : padding + len(lastNTokens)] = lastNTokens
+
+        logits: npt.NDArray[np.single] = self.lastLogits
+        if self.logitBiasIds.size:
+            logits[self.logitBiasIds] *= self.logitBiasValues
         candidates = self.pCandidates
+        candidatesRef = self.pCandidatesRef
         candidatesData = self.pCandidatesData
-        candidatesData["id"][:] = self.pCandidatesDataId
-        candidatesData["logit"][:] = logits
-        candidatesData["p"][:] = self.pCandidatesDataP
-        candidates.data = candidatesData.ctypes.data_as(llama_cpp.llama_token_data_p)
+        # the data pointer is stable, but sampling sorts the candidates in place so the ids have to be restored.
+        # p is always recomputed by llama_sample_softmax before it is read and therefore isn't reset
+        candidatesData["id"] = self.pCandidatesDataId
+        candidatesData["logit"] = logits
         candidates.sorted = llama_cpp.c_bool(False)
         candidates.size = llama_cpp.c_size_t(self.nVocab)
 
         # actually sample the token
         llama_cpp.llama_sample_repetition_penalties(ctx=self.context,
-                                                    candidates=llama_cpp.ctypes.byref(candidates),
+                                                    candidates=candidatesRef,
                                                     last_tokens_data=lastNTokensData,
                                                     penalty_last_n=lastNTokensSize,
                                                     penalty_freq=self.parameters.frequency_penalty,
@@ -143,15 +383,15 @@ class LlamaModel:
 
         if self.parameters.temperature == 0.0:
             id = llama_cpp.llama_sample_token_greedy(ctx=self.context,
-                                                     candidates=llama_cpp.ctypes.byref(candidates))
+                                                     candidates=candidatesRef)
         elif self.parameters.mirostat == 1:
             mirostatMU = llama_cpp.c_float(2.0*self.parameters.mirostat_tau)
             mirostatM = llama_cpp.c_int(100)
             llama_cpp.llama_sample_temperature(ctx=self.context,
-                                               candidates=llama_cpp.ctypes.byref(candidates),
+                                               candidates=candidatesRef,
                                                temp=self.parameters.temperature)
             id = llama_cpp.llama_sample_token_mirostat(ctx=self.context,
-                                                       candidates=llama_cpp.ctypes.byref(candidates),
+                                                       candidates=candidatesRef,
                                                        tau=self.parameters.mirostat_tau,
                                                        eta=self.parameters.mirostat_eta,
                                                        mu=llama_cpp.ctypes.byref(mirostatMU),
@@ -159,105 +399,110 @@ class LlamaModel:
         elif self.parameters.mirostat == 2:
             mirostatMU = llama_cpp.c_float(2.0*self.parameters.mirostat_tau)
             llama_cpp.llama_sample_temperature(ctx=self.context,
-                                               candidates=llama_cpp.ctypes.byref(candidates),
+                                               candidates=candidatesRef,
                                                temp=self.parameters.temperature)
             id = llama_cpp.llama_sample_token_mirostat_v2(ctx=self.context,
-                                                          candidates=llama_cpp.ctypes.byref(candidates),
+                                                          candidates=candidatesRef,
                                                           tau=self.parameters.mirostat_tau,
                                                           eta=self.parameters.mirostat_eta,
                                                           mu=llama_cpp.ctypes.byref(mirostatMU))
         else:   # temperature sampling
             llama_cpp.llama_sample_top_k(ctx=self.context,
-                                         candidates=llama_cpp.ctypes.byref(candidates),
+                                         candidates=candidatesRef,
                                          k=self.parameters.top_k,
                                          min_keep=llama_cpp.c_size_t(1))
             llama_cpp.llama_sample_tail_free(ctx=self.context,
-                                             candidates=llama_cpp.ctypes.byref(candidates),
+                                             candidates=candidatesRef,
                                              z=self.parameters.tfs_z,
                                              min_keep=llama_cpp.c_size_t(1))
             llama_cpp.llama_sample_typical(ctx=self.context,
-                                           candidates=llama_cpp.ctypes.byref(candidates),
+                                           candidates=candidatesRef,
                                            p=llama_cpp.c_float(1.0),
                                            min_keep=llama_cpp.c_size_t(1))
             llama_cpp.llama_sample_top_p(ctx=self.context,
-                                         candidates=llama_cpp.ctypes.byref(candidates),
+                                         candidates=candidatesRef,
                                          p=self.parameters.top_p,
                                          min_keep=llama_cpp.c_size_t(1))
             llama_cpp.llama_sample_temperature(ctx=self.context,
-                                               candidates=llama_cpp.ctypes.byref(candidates),
+                                               candidates=candidatesRef,
                                                temp=self.parameters.temperature)
             id = llama_cpp.llama_sample_token(ctx=self.context,
-                                              candidates=llama_cpp.ctypes.byref(candidates))
+                                              candidates=candidatesRef)
         return id
 
-    def generateTokens(self, tokens: List[int]):
+    def generateTokens(self, tokens: npt.NDArray[np.intc]):
         nTokens = 0
+        self.prefill(tokens=tokens)
         while True:
-            self.evaluate(tokens=tokens, batch=64)
             newToken = self.sampleTokenWithModel()
             tokensON = yield newToken
-            tokens = [newToken]
             if tokensON:
-                tokens.extend(tokensON)
+                self.prefill(tokens=[newToken, *tokensON])
+            else:
+                self.decodeToken(token=newToken)
 
             nTokens += 1
 
-    def tokenToByte(self, token: int) -> bytes:
-        size = 32
-        buffer = (llama_cpp.ctypes.c_char * size)()
-        n = llama_cpp.llama_token_to_piece(self.model, llama_cpp.llama_token(token), buffer, size)
-
-        assert n <= size
-        return bytes(buffer[:n])  # no llama1 support
+    def tokenToByte(self, token: int) -> bytes:   # no llama1 support
+        n = llama_cpp.llama_token_to_piece(self.model, llama_cpp.llama_token(token), self.pieceBuffer,
+                                           self.pieceBufferSize)
+        if n < 0:   # piece does not fit the shared buffer, fall back to a one-off allocation
+            buffer = (llama_cpp.ctypes.c_char * -n)()
+            n = llama_cpp.llama_token_to_piece(self.model, llama_cpp.llama_token(token), buffer, -n)
+            return buffer.raw[:n]
+        return llama_cpp.ctypes.string_at(self.pieceBuffer, n)   # copies only the n bytes of the piece
 
     def tokensToString(self, tokens: List[int]) -> str:
-        buf = b""
+        buf = bytearray()
         for token in tokens:
-            buf += self.tokenToByte(token=token)
+            buf.extend(self.tokenToByte(token=token))
         return buf.decode("utf8", errors="ignore")
 
     def generate(self, stream: bool = False) -> str:   # streaming disabled for now
         antiPrompts: List[str] = self.parameters.antiPrompt
         exitTokens: List[int] = [2, 32002, 32001]
-        tempBytes = b""
+        tempBytes = bytearray()
         finalString = ""
         tokens: List[int] = []
-        tokenizedPromptTokens: List[int] = (self.tokenizeFull(self.parameters.prompt) if self.parameters.prompt != ""
-                                            else [llama_cpp.llama_token_bos(self.context)])
-        
-        if len(tokenizedPromptTokens) >= self.parameters.nCtx:
-            print(f"{tokenizedPromptTokens} tokens were requested to be processed, maximum is "
+
+        llama_cpp.llama_reset_timings(self.context)
+        promptTokens = self.prefillPrompt(prompt=self.parameters.prompt)
+        if promptTokens >= self.parameters.nCtx:
+            print(f"{promptTokens} tokens were requested to be processed, maximum is "
                   f"{llama_cpp.llama_n_ctx(self.context)}")
             return ""
 
-        llama_cpp.llama_reset_timings(self.context)
         if antiPrompts != []:
             encodedAntiPrompts: List[bytes] = [a.encode("utf8") for a in antiPrompts]
         else:
             encodedAntiPrompts: List[bytes] = []
+        maxAntiPromptLength: int = max((len(a) for a in encodedAntiPrompts), default=0)
+        scannedBytes: int = 0   # bytes of tempBytes that were already searched for anti prompts
 
         incompleteFix: int = 0
-        for t in self.generateTokens(tokens=tokenizedPromptTokens):  # should probably remove either tempbytes or
-            if t == self.EOSToken or t in exitTokens:                # finalstring
+        emptyPrompt = np.array([], dtype=np.intc)  # the prompt was already evaluated by prefillPrompt
+        for t in self.generateTokens(tokens=emptyPrompt):  # should probably remove either tempbytes or finalstring
+            if t == self.EOSToken or t in exitTokens:
                 finalString = self.tokensToString(tokens=tokens) if len(finalString)+1 != len(tokens) else finalString
                 break
             tokens.append(t)
-            tempBytes += self.tokenToByte(token=tokens[-1])
+            piece = self.tokenToByte(token=tokens[-1])
+            tempBytes.extend(piece)
 
-            for k, char in enumerate(tempBytes[-3:]):
-                k = 3 - k
-                for number, pattern in [(2, 192), (3, 224), (4, 240)]:
-                    if number > k and pattern & char == pattern:
-                        incompleteFix = number - k
+            missingBytes = utf8MissingBytes(piece)
+            if missingBytes > 0:
+                incompleteFix = missingBytes
 
             if incompleteFix > 0:
                 incompleteFix -= 1
                 continue
 
-            antiPrompt = [a for a in encodedAntiPrompts if a in tempBytes]
-            if len(antiPrompt) > 0:
-                firstAntiPrompt = antiPrompt[0]
-                tempBytes = tempBytes[: tempBytes.index(firstAntiPrompt)]
+            searchStart = max(0, scannedBytes - maxAntiPromptLength + 1)
+            scannedBytes = len(tempBytes)
+            antiPromptIndex = next((i for i in (tempBytes.find(a, searchStart) for a in encodedAntiPrompts)
+                                    if i != -1), -1)
+            if antiPromptIndex != -1:
+                del tempBytes[antiPromptIndex:]
                 break
 
             # implement streaming
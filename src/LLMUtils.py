@@ -1,7 +1,9 @@
 import llama_cpp
 import multiprocessing as mp
+import platform
+import subprocess
 from dataclasses import field
-from typing import List
+from typing import List, Optional
 
 #  An explanation for these parameters can be found at https://abetlen.github.io/llama-cpp-python/
 class LLMConfig:
@@ -13,13 +15,16 @@ class LLMConfig:
         self.modelName = ""
         self.modelType = ""
 
-        self.nOffloadLayer = 0
+        self.nOffloadLayer = -1 if gpuOffloadSupported() is True else 0  # -1 offloads every layer
         self.mainGPU = 0
-        self.threads = mp.cpu_count()
+        self.threads = physicalCoreCount()
 
         self.newlineToken = '\n'
         self.EOT = '\n'
         self.prompt: str = ""
+        # KV cache of the prompt prefix shared between generations is persisted here. Each save writes the full KV
+        # state (hundreds of MB for 7B models at larger contexts), it happens in reset() when the shared prefix changes
+        self.sessionPath: str = None
         self.antiPrompt: List[str] = []
 
         self.seed = -1
@@ -42,7 +47,7 @@ class LLMConfig:
         self.frequency_penalty: int = 0
         self.presence_penalty: int = 0
         self.penalize_nl: bool = False
-        self.n_batch: int = 32
+        self.n_batch: int = 512   # prompt processing batch size, decoding always evaluates single tokens
 
         self.tokenHealing = False
         self.logitsAll = False
@@ -54,5 +59,27 @@ class LLMConfig:
     def getModelParams(self):
         return self.modelParams
 
+# SMT siblings and efficiency cores slow llama.cpp down, so default to physical (performance) cores
+def physicalCoreCount() -> int:
+    if platform.system() == "Darwin":
+        try:
+            return int(subprocess.check_output(["sysctl", "-n", "hw.perflevel0.physicalcpu"]))
+        except (OSError, subprocess.CalledProcessError, ValueError):
+            pass
+    try:
+        import psutil
+        cores = psutil.cpu_count(logical=False)
+        if cores:
+            return cores
+    except ImportError:
+        pass
+    return mp.cpu_count()
+
+# None when the bindings can't tell, older ones only report a BLAS flag which CPU-only OpenBLAS builds set as well
+def gpuOffloadSupported() -> Optional[bool]:
+    if hasattr(llama_cpp, "llama_supports_gpu_offload"):
+        return bool(llama_cpp.llama_supports_gpu_offload())
+    return None
+
 def defaultLlamactxParams():
     return LLMConfig()
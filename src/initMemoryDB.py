@@ -1,51 +1,24 @@
 import memoryDB
+import re
 from typing import List
 
 memDB = memoryDB.MemoryDB(path="insert path to db")
 
 def initSysPrompts(filePath: str):
-    systemPrompts: List[str] = []
-    curPrompt = ""
-
     with open(filePath) as sysPromptFile:
-        for line in sysPromptFile.readlines():
-            if line.find("-=sysPromptSplitter=-") != -1:
-                systemPrompts.append(curPrompt)
-                curPrompt = ""
-            else:
-                curPrompt += line
-        if curPrompt != '':
-            systemPrompts.append(curPrompt)
+        systemPrompts: List[str] = re.split(r"^.*-=sysPromptSplitter=-.*(?:\n|$)", sysPromptFile.read(), flags=re.M)
 
-    for prompt in systemPrompts:
-        memDB.newDBEntry(type="systemPrompt", identifier="generic", content=prompt)
+    systemPrompts = [prompt for prompt in systemPrompts if prompt != ""]
+    memDB.newDBEntries(type="systemPrompt", identifiers=["generic"] * len(systemPrompts), contents=systemPrompts)
 
 def initPersonalityPrompts(filePath: str):
-    personalities: List[str] = []
-    personalityIdentifiers: List[str] = []
-    curPersonality = ""
-    curIdentifier = ""
-
     with open(filePath) as personalitiesFile:
-        for line in personalitiesFile.readlines():
-            if line.find("-=personalitySplitter=-") != -1:
-                print(curPersonality)
-                print(curIdentifier)
-                personalities.append(curPersonality.replace('\n', ''))
-                personalityIdentifiers.append(curIdentifier.replace('\n', ''))
-                curPersonality = ""
-                curIdentifier = ""
-            elif line.find("-=personalityStart=-") != -1:
-                curIdentifier = line[20:]
-            else:
-                curPersonality += line
-        if curPersonality != '':
-            personalities.append(curPersonality.replace('\n', ''))
-            personalityIdentifiers.append(curIdentifier.replace('\n', ''))
-        for personality in personalities:
-            memDB.newDBEntry(type="personality",
-                             identifier=personalityIdentifiers[personalities.index(personality)],
-                             content=personality)
+        personalities = re.findall(r"^-=personalityStart=-([^\n]*)\n(.*?)(?=^-=personalitySplitter=-|\Z)",
+                                   personalitiesFile.read(), flags=re.S | re.M)
+
+    personalityIdentifiers: List[str] = [identifier for identifier, _ in personalities]
+    personalityContents: List[str] = [personality.replace('\n', '') for _, personality in personalities]
+    memDB.newDBEntries(type="personality", identifiers=personalityIdentifiers, contents=personalityContents)
 
 def initInformationMemory(filePath: str):
     content = []
@@ -74,13 +47,16 @@ def initSwearWords(filePath: str, filePathExclusions: str = None):
     with open(filePath) as swearWords:
         swearWordsFull = swearWords.read()
     if filePathExclusions is not None:
-        with open(filePathExclusions):
-            for line in swearWords.readlines():
-                swearWordsFull = swearWordsFull.replace(line, "")
+        with open(filePathExclusions) as exclusionsFile:
+            exclusions = {line for line in exclusionsFile.read().splitlines() if line != ""}
+        if exclusions:   # drop every line of the swear word list that is excluded, in a single pass
+            exclusionPattern = re.compile(r"^(?:" + "|".join(map(re.escape, exclusions)) + r")(?:\n|$)", flags=re.M)
+            swearWordsFull = exclusionPattern.sub("", swearWordsFull)
     if swearWordsFull != "":
         memDB.newDBEntry(type="swearwords", identifier="all", content=swearWordsFull)
 
 initSysPrompts(filePath="insert path to system prompts")
 initPersonalityPrompts(filePath="insert path to personality prompts")
 initInformationMemory(filePath="insert path to information file")
-initSwearWords(filePath="insert path to swear word file")initSysPrompts(filePath="../memories/systemPrompts.txt")
+initSwearWords(filePath="insert path to swear word file")
+initSysPrompts(filePath="../memories/systemPrompts.txt")
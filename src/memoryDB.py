@@ -29,6 +29,28 @@ class MemoryDB:
 
         return 0
 
+    def newDBEntries(self, type: str, identifiers: List[str], contents: List[str]):
+        ids, metadatas, documents = [], [], []
+        pendingIdentifiers = set()
+        nextId = self.chromaCollection.count() + 1
+        for identifier, content in zip(identifiers, contents):
+            if identifier in pendingIdentifiers or self.entryExists(type, identifier):
+                print(f"MemoryDB: Entry of type '{type}' with identifier '{identifier}' already exists in database.\n")
+                continue
+            pendingIdentifiers.add(identifier)
+            ids.append(str(nextId + len(ids)))
+            metadatas.append({"type" : type, "identifier" : identifier})
+            documents.append(content)
+
+        if not ids:
+            return -1
+
+        self.chromaCollection.add(ids=ids, metadatas=metadatas, documents=documents)  # one embedding batch
+
+        print(f"MemoryDB: {len(ids)} new entries with ids '{ids[0]}' to '{ids[-1]}' have been created.\n")
+
+        return 0
+
     def updateDBEntry(self, type: str, identifier: str, content: str):
         if self.entryExists(type, identifier) is False:
             print(f"MemoryDB: Could not update entry with type '{type}' and identifier '{identifier}' as none was found")